@@ -0,0 +1,63 @@
+import asyncio
+import os
+import time
+
+from crypto import ChunkCipher
+from packet import Packet, PacketType
+from peer import MAX_CHUNK_SIZE
+
+CHUNK_COUNT = 64 * 1024
+BATCH_SIZE = 256
+
+
+def report(name: str, seconds: float, baseline: float | None = None) -> None:
+    throughput = CHUNK_COUNT * MAX_CHUNK_SIZE / seconds / 1024 / 1024
+    overhead = f" ({seconds / baseline:.2f}x plaintext)" if baseline else ""
+    print(f"{name:<20} {throughput:8.1f} MiB/s{overhead}")
+
+
+def pack_chunks(chunks: list[tuple[int, bytes]]) -> None:
+    for offset, data in chunks:
+        Packet(PacketType.TRANSFER_CHUNK, (offset // MAX_CHUNK_SIZE).to_bytes(4) + data).pack()
+
+
+async def main() -> None:
+    # same key both ways so the benchmark can open what it sealed
+    key = os.urandom(32)
+    cipher = ChunkCipher(key, key)
+    chunk_data = os.urandom(MAX_CHUNK_SIZE)
+    batches = [
+        [(index * MAX_CHUNK_SIZE, chunk_data) for index in range(start, start + BATCH_SIZE)]
+        for start in range(0, CHUNK_COUNT, BATCH_SIZE)
+    ]
+
+    started = time.perf_counter()
+    for batch in batches:
+        pack_chunks(batch)
+    plaintext = time.perf_counter() - started
+    report("plaintext", plaintext)
+
+    started = time.perf_counter()
+    for batch in batches:
+        sealed = cipher.seal_batch(0, batch)
+        pack_chunks(list(zip((offset for offset, _ in batch), sealed)))
+    report("sealed, on loop", time.perf_counter() - started, plaintext)
+
+    started = time.perf_counter()
+    for batch in batches:
+        sealed = await cipher.seal(0, batch)
+        pack_chunks(list(zip((offset for offset, _ in batch), sealed)))
+    report("sealed, worker pool", time.perf_counter() - started, plaintext)
+
+    sealed_batches = [
+        list(zip((offset for offset, _ in batch), cipher.seal_batch(0, batch)))
+        for batch in batches
+    ]
+    started = time.perf_counter()
+    for batch in sealed_batches:
+        await cipher.open(0, batch)
+    report("opened, worker pool", time.perf_counter() - started, plaintext)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Self
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    NoEncryption,
+    PrivateFormat,
+    PublicFormat,
+)
+
+from tracing import tracer
+
+PUBLIC_KEY_SIZE = 32
+FINGERPRINT_SIZE = 16
+HANDSHAKE_NONCE_SIZE = 16
+SESSION_ID_SIZE = 8
+TAG_SIZE = 16
+# smallest executor job, below this the hand-off costs more than the crypto
+MIN_SLICE_SIZE = 32
+
+WORKER_COUNT = os.cpu_count() or 1
+
+executor = ThreadPoolExecutor(WORKER_COUNT, thread_name_prefix='crypto')
+
+
+def generate_identity() -> X25519PrivateKey:
+    return X25519PrivateKey.generate()
+
+
+def load_identity(path: str) -> X25519PrivateKey:
+    # a stored identity keeps the code's fingerprint stable between runs
+    try:
+        with open(path, 'rb') as f:
+            return X25519PrivateKey.from_private_bytes(f.read())
+    except FileNotFoundError:
+        pass
+
+    identity = generate_identity()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with open(fd, 'wb') as f:
+        f.write(identity.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption()))
+
+    return identity
+
+
+def public_key_bytes(identity: X25519PrivateKey) -> bytes:
+    return identity.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+def fingerprint(public_key: bytes) -> bytes:
+    return hashlib.sha256(public_key).digest()[:FINGERPRINT_SIZE]
+
+
+def _derive(secret: bytes, salt: bytes | None, info: bytes, length: int = 32) -> bytes:
+    return HKDF(hashes.SHA256(), length=length, salt=salt, info=info).derive(secret)
+
+
+def derive_session_secret(
+    identity: X25519PrivateKey,
+    ephemeral: X25519PrivateKey,
+    nonce: bytes,
+    peer_public_key: bytes,
+    peer_ephemeral_key: bytes,
+    peer_nonce: bytes
+) -> bytes:
+    # Noise KK style: ee gives forward secrecy once the ephemeral keys are gone,
+    # es and se tie it to both identities so only the fingerprinted peer can derive it
+    peer_ephemeral = X25519PublicKey.from_public_bytes(peer_ephemeral_key)
+    ephemeral_static = ephemeral.exchange(X25519PublicKey.from_public_bytes(peer_public_key))
+    static_ephemeral = identity.exchange(peer_ephemeral)
+    # one side's es is the other's se, so they go in a fixed order
+    if public_key_bytes(identity) > peer_public_key:
+        ephemeral_static, static_ephemeral = static_ephemeral, ephemeral_static
+    shared_secret = ephemeral.exchange(peer_ephemeral) + ephemeral_static + static_ephemeral
+
+    # both handshake nonces go into the salt so every session gets fresh keys
+    salt = b''.join(sorted((nonce, peer_nonce)))
+    return _derive(shared_secret, salt, b'birdge session secret')
+
+
+def derive_session_id(session_secret: bytes) -> bytes:
+    return _derive(session_secret, None, b'birdge session id', SESSION_ID_SIZE)
+
+
+def resume_proof(session_secret: bytes, data: bytes) -> bytes:
+    return hmac.digest(session_secret, b'birdge resume' + data, 'sha256')[:TAG_SIZE]
+
+
+class ChunkCipher:
+    def __init__(self, send_key: bytes, receive_key: bytes) -> None:
+        self.send_aead = AESGCM(send_key)
+        self.receive_aead = AESGCM(receive_key)
+
+    @classmethod
+    def from_secret(
+        cls,
+        session_secret: bytes,
+        nonce: bytes,
+        peer_nonce: bytes,
+        public_key: bytes,
+        peer_public_key: bytes
+    ) -> Self:
+        # each direction is salted with its sender's nonce, so a side that resumes
+        # with a new nonce only changes the keys for what it sends
+        return cls(
+            _derive(session_secret, nonce, b'birdge chunk key' + public_key + peer_public_key),
+            _derive(session_secret, peer_nonce, b'birdge chunk key' + peer_public_key + public_key)
+        )
+
+    @staticmethod
+    def nonce(transfer_id: int, offset: int) -> bytes:
+        return transfer_id.to_bytes(4) + offset.to_bytes(8)
+
+    def seal_batch(self, transfer_id: int, chunks: list[tuple[int, bytes]]) -> list[bytes]:
+        return [
+            self.send_aead.encrypt(self.nonce(transfer_id, offset), data, None)
+            for offset, data in chunks
+        ]
+
+    def open_batch(self, transfer_id: int, chunks: list[tuple[int, bytes]]) -> list[bytes | None]:
+        opened: list[bytes | None] = []
+        for offset, data in chunks:
+            try:
+                opened.append(self.receive_aead.decrypt(self.nonce(transfer_id, offset), data, None))
+            except InvalidTag:
+                # forged or corrupted, the caller drops it
+                opened.append(None)
+
+        return opened
+
+    async def _run_sliced(self, function, transfer_id: int, chunks: list[tuple[int, bytes]]) -> list:
+        loop = asyncio.get_running_loop()
+        # one slice per worker so a single batch spreads over every core
+        slice_size = max(MIN_SLICE_SIZE, -(-len(chunks) // WORKER_COUNT))
+        results = await asyncio.gather(*(
+            loop.run_in_executor(executor, function, transfer_id, chunks[start:start + slice_size])
+            for start in range(0, len(chunks), slice_size)
+        ))
+        return [item for result in results for item in result]
+
+    async def seal(self, transfer_id: int, chunks: list[tuple[int, bytes]]) -> list[bytes]:
+        with tracer.span('seal'):
+            return await self._run_sliced(self.seal_batch, transfer_id, chunks)
+
+    async def open(self, transfer_id: int, chunks: list[tuple[int, bytes]]) -> list[bytes | None]:
+        with tracer.span('open'):
+            return await self._run_sliced(self.open_batch, transfer_id, chunks)
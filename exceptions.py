@@ -4,3 +4,7 @@ class MissingPeerError(Exception):
 
 class HandshakeError(Exception):
     ...
+
+
+class TransferError(Exception):
+    ...
@@ -0,0 +1,246 @@
+import asyncio
+import ctypes
+import ctypes.util
+import mmap
+import os
+from collections.abc import AsyncGenerator
+from contextlib import suppress
+from dataclasses import dataclass
+
+from tracing import tracer
+
+# O_DIRECT wants buffers, offsets and sizes aligned to the logical block size
+DIRECT_ALIGNMENT = 4096
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+# IOV_MAX on Linux, the most buffers one pwritev takes
+MAX_IOVECS = 1024
+
+
+@dataclass
+class IOPolicy:
+    # sender: bytes per read-ahead block, two blocks are in flight
+    block_size: int = 4 * 1024 * 1024
+    # sender: hint sequential access so the kernel reads ahead further
+    sequential: bool = True
+    # drop pages from the page cache once they're read or safely written
+    drop_cache: bool = True
+    # receiver: written bytes between writebacks
+    flush_interval: int = 64 * 1024 * 1024
+    # sender: bypass the page cache entirely, falls back to buffered reads where unsupported
+    direct: bool = False
+
+    def __post_init__(self) -> None:
+        if self.block_size <= 0:
+            raise ValueError(f"block size must be positive, got {self.block_size}")
+        if self.direct and self.block_size % DIRECT_ALIGNMENT:
+            raise ValueError(
+                f"block size must be a multiple of {DIRECT_ALIGNMENT} with O_DIRECT, got {self.block_size}"
+            )
+
+
+DEFAULT_POLICY = IOPolicy()
+
+
+def _load_sync_file_range():
+    # not exposed by the os module, Linux only
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = libc.sync_file_range
+    except (OSError, AttributeError, TypeError):
+        return None
+
+    function.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+    return function
+
+
+_sync_file_range = _load_sync_file_range()
+
+
+def advise(fd: int, offset: int, length: int, advice_name: str) -> None:
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, 'posix_fadvise'):
+        return
+
+    with suppress(OSError):
+        os.posix_fadvise(fd, offset, length, advice)
+
+
+def sync_range(fd: int, offset: int, length: int, flags: int) -> None:
+    if _sync_file_range is None:
+        # waits for the whole file instead of a range, but still bounds dirty pages
+        if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+            os.fdatasync(fd)
+        return
+
+    if _sync_file_range(fd, offset, length, flags) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def _open_for_reading(path: str, direct: bool) -> tuple[int, bool]:
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, os.O_RDONLY | os.O_DIRECT), True
+        except OSError:
+            # tmpfs and some network filesystems refuse O_DIRECT
+            pass
+
+    return os.open(path, os.O_RDONLY), False
+
+
+def _read_block(fd: int, buffer: mmap.mmap, offset: int) -> int:
+    with tracer.span('read'):
+        return os.preadv(fd, [buffer], offset)
+
+
+async def read_chunks(
+    path: str,
+    chunk_size: int,
+    policy: IOPolicy = DEFAULT_POLICY
+) -> AsyncGenerator[bytes]:
+    # a block shorter than a chunk would cut chunks short in the middle of the file
+    if policy.block_size < chunk_size:
+        raise ValueError(
+            f"block size must be at least the chunk size ({chunk_size}), got {policy.block_size}"
+        )
+
+    loop = asyncio.get_running_loop()
+    fd, direct = _open_for_reading(path, policy.direct)
+    try:
+        # mmap memory is page aligned, which satisfies O_DIRECT
+        buffers = [mmap.mmap(-1, policy.block_size) for _ in range(2)]
+        pending = None
+        block = None
+        try:
+            if policy.sequential:
+                advise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+            # double buffering: the next block is read while this one is being sent
+            offset = 0
+            pending = loop.run_in_executor(None, _read_block, fd, buffers[0], offset)
+            buffer_index = 0
+            leftover = b''
+
+            while size := await pending:
+                block = memoryview(buffers[buffer_index])[:size]
+                buffer_index ^= 1
+                pending = loop.run_in_executor(None, _read_block, fd, buffers[buffer_index], offset + size)
+
+                position = 0
+                if leftover:
+                    position = chunk_size - len(leftover)
+                    yield leftover + block[:position]
+                # chunks are copied out, so the buffer can be refilled while they wait to be sealed
+                while position + chunk_size <= size:
+                    yield bytes(block[position:position + chunk_size])
+                    position += chunk_size
+                leftover = bytes(block[position:])
+                block.release()
+
+                if policy.drop_cache and not direct:
+                    advise(fd, offset, size, 'POSIX_FADV_DONTNEED')
+                offset += size
+
+            if leftover:
+                yield leftover
+        finally:
+            # the consumer can stop at any yield, while the view still holds a buffer
+            if block is not None:
+                block.release()
+            if pending is not None:
+                # the executor may still be reading into a buffer
+                with suppress(Exception):
+                    await pending
+            for buffer in buffers:
+                buffer.close()
+    finally:
+        os.close(fd)
+
+
+def read_chunks_at(path: str, chunk_size: int, chunk_indices: list[int]) -> list[tuple[int, bytes]]:
+    # for resends, which are few and scattered, so plain buffered reads
+    with open(path, 'rb') as f:
+        return [
+            (chunk_index * chunk_size, os.pread(f.fileno(), chunk_size, chunk_index * chunk_size))
+            for chunk_index in chunk_indices
+        ]
+
+
+def _write_chunks(fd: int, chunks: list[tuple[int, bytes]]) -> None:
+    chunks = sorted(chunks, key=lambda chunk: chunk[0])
+    start = 0
+    while start < len(chunks):
+        # chunks that follow each other in the file go out in one pwritev
+        end = start + 1
+        while (
+            end < len(chunks)
+            and end - start < MAX_IOVECS
+            and chunks[end][0] == chunks[end - 1][0] + len(chunks[end - 1][1])
+        ):
+            end += 1
+
+        offset = chunks[start][0]
+        buffers = [data for _, data in chunks[start:end]]
+        size = sum(len(buffer) for buffer in buffers)
+        written = os.pwritev(fd, buffers, offset)
+        if written < size:
+            # regular files rarely take less than asked, the rest goes out plainly
+            data = b''.join(buffers)
+            while written < size:
+                written += os.pwrite(fd, data[written:], offset + written)
+
+        start = end
+
+
+async def write_chunks(fd: int, chunks: list[tuple[int, bytes]]) -> None:
+    # one executor hop per batch of (offset, data) rather than a seek and a write per chunk
+    with tracer.span('write_chunks'):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _write_chunks, fd, chunks)
+
+
+class Writeback:
+    def __init__(self, fd: int, policy: IOPolicy = DEFAULT_POLICY) -> None:
+        self.fd = fd
+        self.policy = policy
+        # [0, written) has had writeback started, [0, dropped) is clean and out of the cache
+        self.written = 0
+        self.dropped = 0
+
+    def _flush_window(self, end: int) -> None:
+        # start writing the new window without waiting, then wait for the previous
+        # one (its writeback has long been under way) and drop it from the cache
+        sync_range(self.fd, self.written, end - self.written, SYNC_FILE_RANGE_WRITE)
+        if self.written > self.dropped:
+            sync_range(
+                self.fd,
+                self.dropped,
+                self.written - self.dropped,
+                SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER
+            )
+            if self.policy.drop_cache:
+                advise(self.fd, self.dropped, self.written - self.dropped, 'POSIX_FADV_DONTNEED')
+            self.dropped = self.written
+        self.written = end
+
+    async def advance(self, offset: int) -> None:
+        # chunks can arrive out of order, windows follow the highest offset written
+        if offset - self.written < self.policy.flush_interval:
+            return
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._flush_window, offset)
+
+    def _finish(self) -> None:
+        # sync_file_range is fine for bounding dirty pages, but it flushes neither the
+        # metadata nor the disk's write cache, so the file is only durable after this
+        os.fdatasync(self.fd)
+        if self.policy.drop_cache:
+            advise(self.fd, 0, 0, 'POSIX_FADV_DONTNEED')
+
+    async def finish(self) -> None:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._finish)
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from exceptions import TransferError
+from io_policy import DEFAULT_POLICY, IOPolicy
+from peer import Peer
+
+
+@dataclass
+class TransferJob:
+    peer: Peer
+    path: str
+    size: int = 0
+    seconds: float = 0.0
+    error: Exception | None = None
+    done: bool = False
+
+
+class TransferQueue:
+    def __init__(self, max_parallel: int = 4, policy: IOPolicy = DEFAULT_POLICY) -> None:
+        self.max_parallel = max_parallel
+        self.policy = policy
+        self.jobs: list[TransferJob] = []
+
+    def add(self, peer: Peer, path: str) -> TransferJob:
+        job = TransferJob(peer, path)
+        self.jobs.append(job)
+        return job
+
+    async def _run_job(self, job: TransferJob) -> None:
+        started = time.perf_counter()
+        try:
+            job.size = os.stat(job.path).st_size
+            await job.peer.send_file(job.path, self.policy)
+        except Exception as error:
+            job.error = error
+        finally:
+            job.seconds = time.perf_counter() - started
+            job.done = True
+
+    async def _run_peer(
+        self,
+        jobs: list[TransferJob],
+        slots: asyncio.Semaphore,
+        on_done: Callable[[TransferJob], None] | None
+    ) -> None:
+        # one session carries one transfer at a time, files for a peer go in order
+        session_error: TransferError | None = None
+        for job in jobs:
+            if session_error is not None:
+                # the receiver stopped answering, the rest would only wait out the same timeout
+                job.error = session_error
+                job.done = True
+            else:
+                async with slots:
+                    await self._run_job(job)
+                if isinstance(job.error, TransferError):
+                    session_error = job.error
+
+            if on_done is not None:
+                on_done(job)
+
+    async def run(self, on_done: Callable[[TransferJob], None] | None = None) -> list[TransferJob]:
+        # on_done is called with each job as it finishes, whichever peer it's for
+        jobs_by_peer: dict[Peer, list[TransferJob]] = {}
+        for job in self.jobs:
+            if not job.done:
+                jobs_by_peer.setdefault(job.peer, []).append(job)
+
+        # sessions are reused for every file, parallelism comes from peers
+        slots = asyncio.Semaphore(self.max_parallel)
+        await asyncio.gather(*(
+            self._run_peer(jobs, slots, on_done)
+            for jobs in jobs_by_peer.values()
+        ))
+
+        return self.jobs
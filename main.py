@@ -1,188 +1,220 @@
+import argparse
 import asyncio
-import math
+import json
 import os
-from asyncio import AbstractEventLoop, DatagramTransport
-from dataclasses import dataclass
-from enum import Enum
-from typing import Self
-
-import aiofiles
-from aiofiles.threadpool.binary import AsyncBufferedReader
-
-from exceptions import HandshakeError
-from protocol import PeerProtocol
+import sys
+import time
+from contextlib import redirect_stdout
+
+from crypto import fingerprint, generate_identity, load_identity, public_key_bytes
+from io_policy import IOPolicy
+from jobs import TransferJob, TransferQueue
+from peer import MAX_CHUNK_SIZE, Peer
+from ticket import ResumptionTicket
+from tracing import profile, tracer
 from utils import (
-    Address,
-    address_to_code,
-    chunkify_file,
-    code_to_address,
-    get_external_address,
-    save_chunk,
+    candidates_to_code,
+    code_to_candidates,
+    code_to_fingerprint,
+    gather_candidates,
+    parse_address,
+    session_key,
 )
 
-MAX_PACKET_SIZE = 1472
-MAX_CHUNK_SIZE = MAX_PACKET_SIZE - 4
-
-
-class PacketType(Enum):
-    CONNECT = 0
-    ACCEPT = 1
-    TRANSFER_BEGIN = 2
-    TRANSFER_CHUNK = 3
-
-
-@dataclass
-class Packet:
-    type: PacketType
-    payload: bytes = b''
-
-    def pack(self) -> bytes:
-        return self.type.value.to_bytes(1) + self.payload
-    
-    @classmethod
-    def unpack(cls, data: bytes) -> Self:
-        type = PacketType(int.from_bytes(data[:1]))
-        payload = data[1:]
-
-        return cls(type, payload)
-    
-
-class PeerState(Enum):
-    DISCONNECTED = 0
-    CONNECTED = 1
-    TRANSFER_BEGIN = 2
-    TRANSFER_CHUNK = 3
-
-
-class Peer:
-    state: PeerState = PeerState.DISCONNECTED
-
-    def __init__(
-        self,
-        transport: DatagramTransport,
-        protocol: PeerProtocol
-    ) -> None:
-        self.transport = transport
-        self.protocol = protocol
-
-    @classmethod
-    async def connect(
-        cls,
-        address: Address,
-        loop: AbstractEventLoop | None = None
-    ) -> Self:
-        loop = loop or asyncio.get_running_loop()
-        transport, protocol = await loop.create_datagram_endpoint(
-            PeerProtocol, ('0.0.0.0', 2025), address
-        )
 
-        peer = cls(transport, protocol)
-        await peer.send(Packet(PacketType.CONNECT))
+class Output:
+    def __init__(self, json_mode: bool) -> None:
+        self.json_mode = json_mode
+        # library progress messages go to stderr so stdout stays machine-readable
+        self.stream = sys.stdout
+
+    def emit(self, event: str, message: str, **fields) -> None:
+        if self.json_mode:
+            print(json.dumps({'event': event, **fields}), file=self.stream, flush=True)
+        else:
+            print(message, file=self.stream, flush=True)
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def io_policy(args: argparse.Namespace) -> IOPolicy:
+    if args.block_size < MAX_CHUNK_SIZE:
+        raise ValueError(f"block size must be at least one chunk ({MAX_CHUNK_SIZE} bytes)")
+
+    return IOPolicy(
+        block_size=args.block_size,
+        drop_cache=not args.keep_cache,
+        direct=args.direct
+    )
 
-        packet = await peer.receive()
-        match packet.type:
-            case PacketType.CONNECT:
-                await peer.send(Packet(PacketType.ACCEPT))
-                peer.state = PeerState.CONNECTED
-            case PacketType.ACCEPT:
-                peer.state = PeerState.CONNECTED
-            case _:
-                raise HandshakeError(f"incorrect incoming packet during handshake ({packet.type.name})")
 
+async def connect(args: argparse.Namespace, output: Output) -> Peer:
+    if args.ticket and os.path.exists(args.ticket):
+        peer = await Peer.resume(ResumptionTicket.load(args.ticket), port=args.port, timeout=args.timeout)
+        output.emit(
+            'resumed',
+            f"Resumed session with {peer.address[0]}:{peer.address[1]}",
+            address=f"{peer.address[0]}:{peer.address[1]}"
+        )
         return peer
 
-    async def send(self, packet: Packet) -> None:
-        self.transport.sendto(packet.pack())
-
-    async def receive(self) -> Packet:
-        data, _ = await self.protocol.recvfrom()
-        packet = Packet.unpack(data)
-
-        # happens when NAT is already open so ACCEPT packets end up on both sides
-        if (
-            packet.type == PacketType.ACCEPT
-            and self.state == PeerState.CONNECTED
-        ):
-            return await self.receive()
-        
-        return packet
-    
-    async def _send_chunk(self, chunk_index: int, chunk_data: bytes) -> None:
-        await self.send(Packet(
-            PacketType.TRANSFER_CHUNK,
-            chunk_index.to_bytes(4) + chunk_data
-        ))
-    
-    async def send_file(self, file: AsyncBufferedReader) -> None:
-        # round up
-        chunk_count = math.ceil(os.stat(file.name).st_size / MAX_CHUNK_SIZE)
-        
-        filename = str(file.name).replace('\\', '/').split('/')[-1] or 'unknown'
-
-        await self.send(Packet(
-            PacketType.TRANSFER_BEGIN,
-            chunk_count.to_bytes(4) + filename[:256].encode()
-        ))
-        print("Transfer started!")
-
-        chunk_index = 0
-        # await asyncio.gather(*(
-        #     self._send_chunk(chunk)
-        #     async for chunk_data in chunkify_file(file, MAX_CHUNK_SIZE)
-        # ))
-        async for chunk_data in chunkify_file(file, MAX_CHUNK_SIZE):
-            await self._send_chunk(chunk_index, chunk_data)
-            chunk_index += 1
-    
-    async def _receive_chunk(self, file: AsyncBufferedReader) -> None:
-        chunk_packet = await self.receive()
-        if chunk_packet.type != PacketType.TRANSFER_CHUNK:
-            raise ValueError(f"expected TRANSFER_CHUNK, got {chunk_packet.type.name}")
-        
-        chunk_index = int.from_bytes(chunk_packet.payload[:4])
-        chunk_data = chunk_packet.payload[4:]
-        
-        await save_chunk(file, chunk_index, MAX_CHUNK_SIZE, chunk_data)
-
-    async def receive_file(self) -> AsyncBufferedReader:
-        initial_packet = await self.receive()
-        if initial_packet.type != PacketType.TRANSFER_BEGIN:
-            raise ValueError(f"expected TRANSFER_BEGIN, got {initial_packet.type.name}")
-        
-        chunk_count = int.from_bytes(initial_packet.payload[:4])
-        file_name = initial_packet.payload[4:260].decode()
-        file_size = chunk_count * MAX_CHUNK_SIZE
-
-        print(f"Receiving file `{file_name}` ({chunk_count} chunks, {round(file_size / 1024 / 1024)} MiB)")
-
-        async with aiofiles.open(file_name, 'w+b') as f:
-            await f.truncate(file_size)
-            await asyncio.sleep(3)
-            await asyncio.gather(*(self._receive_chunk(f) for _ in range(chunk_count)))
-        
-        return f
-
-
-async def main():
-    my_addr = get_external_address()  # ! synchronous I/O
-    my_code = address_to_code(my_addr)
-    print(f"Your code: {my_code}")
-
-    peer_code = input("Peer's code: ")
-    peer_addr = code_to_address(peer_code)
-
-    peer = await Peer.connect(peer_addr)
-    print("Connected!")
-
-    mode = input("Select mode (recv, send): ")
-    match mode:
-        case 'recv':
-            await peer.receive_file()
-        case 'send':
-            async with aiofiles.open("../image.png", 'rb') as f:  # ../Teardown 2024-08-07.zip
-                await peer.send_file(f)
-        case _:
-            raise ValueError("unknown mode")
-    
-
-asyncio.run(main())
+    identity = load_identity(args.identity) if args.identity else generate_identity()
+    my_candidates = gather_candidates(args.port)  # ! synchronous I/O
+    my_code = candidates_to_code(my_candidates, fingerprint(public_key_bytes(identity)))
+    output.emit('code', f"Your code: {my_code}", code=my_code)
+
+    # without --peer the code is read from stdin, so it can be piped in as well
+    peer_code = args.peer or sys.stdin.readline().strip()
+    if not peer_code:
+        raise ValueError("no peer code given")
+
+    peer = await Peer.connect(
+        code_to_candidates(peer_code),
+        identity,
+        code_to_fingerprint(peer_code),
+        port=args.port,
+        timeout=args.timeout,
+        relay=parse_address(args.relay) if args.relay else None,
+        relay_key=session_key(my_code, peer_code)
+    )
+    output.emit(
+        'connected',
+        f"Connected via {peer.address[0]}:{peer.address[1]}!",
+        address=f"{peer.address[0]}:{peer.address[1]}"
+    )
+
+    if args.ticket:
+        peer.ticket().save(args.ticket)
+    return peer
+
+
+async def disconnect(args: argparse.Namespace, peer: Peer) -> None:
+    await peer.close()
+    # the peer may have resumed with new keys since the ticket was written
+    if args.ticket:
+        peer.ticket().save(args.ticket)
+
+
+async def send(args: argparse.Namespace, output: Output) -> int:
+    peer = await connect(args, output)
+
+    queue = TransferQueue(policy=args.policy)
+    for path in args.files:
+        queue.add(peer, path)
+
+    # reported as each file finishes, not once the whole queue is through
+    def report(job: TransferJob) -> None:
+        if job.error is not None:
+            output.emit('failed', f"Failed to send {job.path}: {job.error}", path=job.path, error=str(job.error))
+            return
+
+        output.emit(
+            'sent',
+            f"Sent {job.path} ({job.size} bytes in {job.seconds:.2f}s)",
+            path=job.path,
+            size=job.size,
+            seconds=job.seconds
+        )
+
+    try:
+        jobs = await queue.run(report)
+    finally:
+        await disconnect(args, peer)
+
+    return 1 if any(job.error is not None for job in jobs) else 0
+
+
+async def receive(args: argparse.Namespace, output: Output) -> int:
+    peer = await connect(args, output)
+
+    try:
+        started = time.perf_counter()
+        async for file in peer.receive_files(args.directory, args.policy):
+            output.emit(
+                'received',
+                f"Received {file.name}",
+                path=str(file.name),
+                seconds=time.perf_counter() - started
+            )
+            started = time.perf_counter()
+    finally:
+        await disconnect(args, peer)
+
+    return 0
+
+
+async def run(args: argparse.Namespace, output: Output) -> int:
+    if args.trace:
+        tracer.enable(args.trace_sample)
+
+    if args.profile:
+        code = await profile(args.handler(args, output), args.profile)
+    else:
+        code = await args.handler(args, output)
+
+    if args.trace:
+        tracer.write(args.trace)
+        print(tracer.summary(), file=sys.stderr)
+
+    return code
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='birdge', description="peer-to-peer file transfer over UDP")
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--peer', help="peer's code, read from stdin when omitted")
+    common.add_argument('--port', type=int, default=2025)
+    common.add_argument('--timeout', type=float, default=30.0)
+    common.add_argument('--relay', default=os.environ.get('BIRDGE_RELAY'), help="relay address (host:port)")
+    common.add_argument('--identity', help="key file that keeps your code stable between runs")
+    common.add_argument('--ticket', help="resume the session stored here, or store the new one")
+    common.add_argument('--block-size', type=int, default=IOPolicy.block_size, help="read-ahead block size")
+    common.add_argument('--keep-cache', action='store_true', help="leave transferred data in the page cache")
+    common.add_argument('--direct', action='store_true', help="read with O_DIRECT where supported")
+    common.add_argument('--json', action='store_true', help="print one JSON object per event")
+    common.add_argument('--trace', default=os.environ.get('BIRDGE_TRACE'), help="write a Chrome trace here")
+    common.add_argument(
+        '--trace-sample',
+        type=positive_int,
+        default=os.environ.get('BIRDGE_TRACE_SAMPLE', '1'),
+        help="trace one in this many spans per stage"
+    )
+    common.add_argument('--profile', default=os.environ.get('BIRDGE_PROFILE'), help="write cProfile stats here")
+
+    subparsers = parser.add_subparsers(required=True)
+
+    send_parser = subparsers.add_parser('send', parents=[common], help="send files to a peer")
+    send_parser.add_argument('files', nargs='+')
+    send_parser.set_defaults(handler=send)
+
+    receive_parser = subparsers.add_parser('receive', parents=[common], help="receive files from a peer")
+    receive_parser.add_argument('--directory', default='.')
+    receive_parser.set_defaults(handler=receive)
+
+    return parser
+
+
+def main() -> int:
+    parser = build_parser()
+    args = parser.parse_args()
+    try:
+        args.policy = io_policy(args)
+    except ValueError as error:
+        parser.error(str(error))
+    output = Output(args.json)
+
+    if not args.json:
+        return asyncio.run(run(args, output))
+
+    with redirect_stdout(sys.stderr):
+        return asyncio.run(run(args, output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,42 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Self
+
+
+class PacketType(Enum):
+    CONNECT = 0
+    ACCEPT = 1
+    TRANSFER_BEGIN = 2
+    TRANSFER_CHUNK = 3
+    RELAY_BIND = 4
+    RELAY_REDIRECT = 5
+    RELAY_READY = 6
+    DISCONNECT = 7
+    TRANSFER_END = 8
+    TRANSFER_STATUS = 9
+    KEEPALIVE = 10
+    RESUME = 11
+
+
+@dataclass
+class Packet:
+    type: PacketType
+    payload: bytes = b''
+
+    def pack(self) -> bytes:
+        return self.type.value.to_bytes(1) + self.payload
+    
+    @classmethod
+    def unpack(cls, data: bytes) -> Self:
+        type = PacketType(int.from_bytes(data[:1]))
+        payload = data[1:]
+
+        return cls(type, payload)
+
+
+def unpack_packet(data: bytes) -> Packet | None:
+    # for datagrams from the open internet, where garbage is expected
+    try:
+        return Packet.unpack(data)
+    except ValueError:
+        return None
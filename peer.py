@@ -0,0 +1,845 @@
+import asyncio
+import hmac
+import math
+import os
+import socket
+import time
+from asyncio import AbstractEventLoop, DatagramTransport
+from collections.abc import AsyncGenerator
+from contextlib import suppress
+from enum import Enum
+from typing import Self
+
+import aiofiles
+from aiofiles.threadpool.binary import AsyncFileIO
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from crypto import (
+    HANDSHAKE_NONCE_SIZE,
+    PUBLIC_KEY_SIZE,
+    SESSION_ID_SIZE,
+    TAG_SIZE,
+    ChunkCipher,
+    derive_session_id,
+    derive_session_secret,
+    fingerprint,
+    public_key_bytes,
+    resume_proof,
+)
+from exceptions import HandshakeError, TransferError
+from io_policy import (
+    DEFAULT_POLICY,
+    IOPolicy,
+    Writeback,
+    read_chunks,
+    read_chunks_at,
+    write_chunks,
+)
+from packet import Packet, PacketType, unpack_packet
+from protocol import PeerProtocol
+from ticket import ResumptionTicket
+from tracing import tracer
+from utils import (
+    Address,
+    create_udp_socket,
+    normalize_address,
+    resolve_address,
+    to_socket_address,
+)
+
+MAX_PACKET_SIZE = 1472
+# packet type and chunk index in front, authentication tag behind
+MAX_CHUNK_SIZE = MAX_PACKET_SIZE - 5 - TAG_SIZE
+# chunks sealed or opened per round trip to the crypto workers
+CRYPTO_BATCH_SIZE = 256
+DISCONNECT_REPEATS = 3
+# how long the sender waits for the receiver's status before asking again, and in total
+STATUS_INTERVAL = 0.5
+STATUS_TIMEOUT = 30.0
+# missing chunks are reported as runs, as many as fit in one packet
+MAX_MISSING_RANGES = 200
+# and no more than this many chunks are asked for at once
+MAX_MISSING_REPORT = 4096
+# well under the 30 s that many NATs give an idle UDP binding
+KEEPALIVE_INTERVAL = 15.0
+# keepalives and sealed messages have nonce spaces of their own, transfer ids never reach them
+CONTROL_TRANSFER_ID = 0xFFFFFFFF
+MESSAGE_TRANSFER_ID = 0xFFFFFFFE
+# how far a RESUME timestamp may be from our clock before it's taken as a replay
+RESUME_WINDOW = 300.0
+CONTROL_PACKET_VALUES = frozenset((PacketType.KEEPALIVE.value, PacketType.RESUME.value))
+TRANSFER_MESSAGE_TYPES = (PacketType.TRANSFER_BEGIN, PacketType.TRANSFER_END, PacketType.DISCONNECT)
+# sealed with the session key, so they prove the peer sent them whatever the address
+SEALED_PACKET_TYPES = (
+    PacketType.TRANSFER_BEGIN,
+    PacketType.TRANSFER_CHUNK,
+    PacketType.TRANSFER_END,
+    PacketType.TRANSFER_STATUS,
+    PacketType.DISCONNECT,
+)
+RELAY_PACKET_TYPES = (PacketType.RELAY_BIND, PacketType.RELAY_REDIRECT, PacketType.RELAY_READY)
+
+
+def _missing_ranges(received: bytearray, chunk_count: int) -> list[tuple[int, int]]:
+    # runs of chunks not in the bitmap as (first index, count)
+    ranges: list[tuple[int, int]] = []
+    reported = 0
+    for byte_index, byte in enumerate(received):
+        if byte == 0xFF:
+            continue
+
+        for chunk_index in range(byte_index * 8, min(byte_index * 8 + 8, chunk_count)):
+            if byte & 1 << chunk_index % 8:
+                continue
+
+            if ranges and sum(ranges[-1]) == chunk_index:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+            elif len(ranges) == MAX_MISSING_RANGES:
+                return ranges
+            else:
+                ranges.append((chunk_index, 1))
+
+            reported += 1
+            if reported == MAX_MISSING_REPORT:
+                return ranges
+
+    return ranges
+
+
+def _first_transfer_id(nonce: bytes) -> int:
+    # every nonce starts its own epoch of ids, so a resumed session never reuses one the
+    # peer may still be receiving; the top bit stays clear of the ids reserved above
+    return (int.from_bytes(nonce[:2]) & 0x7FFF) << 16
+
+
+class PeerState(Enum):
+    DISCONNECTED = 0
+    CONNECTED = 1
+    TRANSFER_BEGIN = 2
+    TRANSFER_CHUNK = 3
+
+
+class Peer:
+    state: PeerState = PeerState.DISCONNECTED
+    address: Address | None = None
+    cipher: ChunkCipher | None = None
+    session_id: bytes | None = None
+
+    def __init__(
+        self,
+        transport: DatagramTransport,
+        protocol: PeerProtocol,
+        identity: X25519PrivateKey | None,
+        peer_fingerprint: bytes
+    ) -> None:
+        self.transport = transport
+        self.protocol = protocol
+        self.protocol.control_handler = self._handle_control
+        self.family = transport.get_extra_info('socket').family
+        # every address the peer has proven to own, packets from others are dropped
+        self.known_addresses: set[Address] = set()
+
+        # resumed sessions have no identity, the ticket's secret stands in for it
+        self.identity = identity
+        self.public_key = public_key_bytes(identity) if identity else b''
+        self.peer_fingerprint = peer_fingerprint
+        # one per connect, dropped once the session secret is derived
+        self.ephemeral: X25519PrivateKey | None = X25519PrivateKey.generate()
+        self.ephemeral_public_key = public_key_bytes(self.ephemeral)
+        self.nonce = os.urandom(HANDSHAKE_NONCE_SIZE)
+        self.next_transfer_id = _first_transfer_id(self.nonce)
+        # the peer's transfers we have every chunk of
+        self.finished_transfers: set[int] = set()
+        # RESUMEs accepted so far, a file being received when one comes in is cut off
+        self.resume_count = 0
+
+        self.session_secret = b''
+        self.peer_public_key = b''
+        self.peer_nonce = b''
+        self.keepalive_counter = 0
+        self.peer_keepalive_counter = -1
+        self.message_counter = 0
+        # messages can be reordered, so every counter seen is kept rather than the highest
+        self.peer_message_counters: set[int] = set()
+        self.peer_resume_time = 0
+        # our RESUME while it's unanswered, and the one we last answered the peer's with
+        self.resume_packet: Packet | None = None
+        self.resume_reply: Packet | None = None
+        # set once the peer answers our RESUME with its own
+        self.confirmed = asyncio.Event()
+        self.tasks: list[asyncio.Task] = []
+
+    @classmethod
+    async def connect(
+        cls,
+        candidates: list[Address],
+        identity: X25519PrivateKey,
+        peer_fingerprint: bytes,
+        *,
+        port: int = 2025,
+        timeout: float = 30.0,
+        probe_interval: float = 0.25,
+        keepalive_interval: float = KEEPALIVE_INTERVAL,
+        relay: tuple[str, int] | None = None,
+        relay_key: bytes = b'',
+        loop: AbstractEventLoop | None = None
+    ) -> Self:
+        loop = loop or asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            PeerProtocol, sock=create_udp_socket(port)
+        )
+
+        peer = cls(transport, protocol, identity, peer_fingerprint)
+        try:
+            try:
+                await asyncio.wait_for(peer._race(candidates, probe_interval), timeout)
+            except TimeoutError:
+                if relay is None:
+                    raise
+                # hole punching failed (symmetric NAT, CGNAT), go through the relay instead
+                print("Direct connection failed, falling back to relay")
+                await asyncio.wait_for(peer._bind_relay(relay, relay_key, probe_interval), timeout)
+                await asyncio.wait_for(peer._race([peer.address], probe_interval), timeout)
+        except TimeoutError:
+            transport.close()
+            raise HandshakeError("none of the peer's candidates answered") from None
+        except BaseException:
+            # cancelled or failed some other way, the port is freed all the same
+            transport.close()
+            raise
+
+        peer.tasks.append(asyncio.create_task(peer._keepalive(keepalive_interval)))
+        return peer
+
+    @classmethod
+    async def resume(
+        cls,
+        ticket: ResumptionTicket,
+        *,
+        port: int = 2025,
+        timeout: float = 30.0,
+        probe_interval: float = 0.25,
+        keepalive_interval: float = KEEPALIVE_INTERVAL,
+        loop: AbstractEventLoop | None = None
+    ) -> Self:
+        loop = loop or asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            PeerProtocol, sock=create_udp_socket(port)
+        )
+
+        peer = cls(transport, protocol, None, fingerprint(ticket.peer_public_key))
+        peer.public_key = ticket.public_key
+        peer.address = ticket.address
+        peer.known_addresses.add(ticket.address)
+        peer._start_session(ticket.session_secret, ticket.peer_public_key, ticket.peer_nonce)
+        peer.state = PeerState.CONNECTED
+
+        # 0-RTT: no STUN, no codes, no handshake; RESUME goes out ahead of whatever
+        # the caller sends next and is repeated until the peer answers
+        peer.resume_packet = peer._resume_packet()
+        peer._send_now(peer.resume_packet)
+        peer.tasks.append(asyncio.create_task(
+            peer._announce_resume(peer.resume_packet, probe_interval, timeout)
+        ))
+        peer.tasks.append(asyncio.create_task(peer._keepalive(keepalive_interval)))
+        return peer
+
+    def ticket(self) -> ResumptionTicket:
+        return ResumptionTicket(
+            self.session_id,
+            self.session_secret,
+            self.public_key,
+            self.peer_public_key,
+            self.peer_nonce,
+            self.address
+        )
+
+    def _start_session(self, session_secret: bytes, peer_public_key: bytes, peer_nonce: bytes) -> None:
+        self.session_secret = session_secret
+        self.session_id = derive_session_id(session_secret)
+        self.peer_public_key = peer_public_key
+        self.peer_nonce = peer_nonce
+        self.cipher = ChunkCipher.from_secret(
+            session_secret, self.nonce, peer_nonce, self.public_key, peer_public_key
+        )
+
+    async def _probe(self, candidates: list[Address], interval: float) -> None:
+        while True:
+            for candidate in candidates:
+                self.transport.sendto(
+                    Packet(PacketType.CONNECT, self._hello()).pack(),
+                    to_socket_address(candidate, self.family)
+                )
+            await asyncio.sleep(interval)
+
+    def _hello(self) -> bytes:
+        return self.public_key + self.nonce + self.ephemeral_public_key
+
+    def _authenticate(self, hello: bytes) -> bool:
+        peer_public_key = hello[:PUBLIC_KEY_SIZE]
+        peer_nonce = hello[PUBLIC_KEY_SIZE:PUBLIC_KEY_SIZE + HANDSHAKE_NONCE_SIZE]
+        peer_ephemeral_key = hello[PUBLIC_KEY_SIZE + HANDSHAKE_NONCE_SIZE:][:PUBLIC_KEY_SIZE]
+        # the fingerprint came with the peer's code, so a key that matches it is the peer's
+        if (
+            len(peer_ephemeral_key) != PUBLIC_KEY_SIZE
+            or fingerprint(peer_public_key) != self.peer_fingerprint
+        ):
+            return False
+
+        try:
+            session_secret = derive_session_secret(
+                self.identity,
+                self.ephemeral,
+                self.nonce,
+                peer_public_key,
+                peer_ephemeral_key,
+                peer_nonce
+            )
+        except ValueError:
+            # a low-order ephemeral key, no shared secret comes out of it
+            return False
+
+        self._start_session(session_secret, peer_public_key, peer_nonce)
+        self.ephemeral = None
+        return True
+
+    def _send_now(self, packet: Packet) -> None:
+        self.transport.sendto(packet.pack(), to_socket_address(self.address, self.family))
+
+    def _migrate(self, addr: Address) -> None:
+        # the session id and a valid tag prove it's the peer, whatever the address
+        if addr != self.address:
+            print(f"Peer moved to {addr[0]}:{addr[1]}")
+            self.address = addr
+            self.known_addresses.add(addr)
+
+    def _handle_control(self, data: bytes, addr: tuple) -> bool:
+        if not data or data[0] not in CONTROL_PACKET_VALUES:
+            return False
+        # nothing to check them against before the handshake is done
+        if self.cipher is None:
+            return True
+
+        packet = Packet.unpack(data)
+        addr = normalize_address(addr)
+        match packet.type:
+            # until the peer answers our RESUME its key is the one from the ticket,
+            # which recorded keepalives from the old session pass as well
+            case PacketType.KEEPALIVE if self.resume_packet is None:
+                self._receive_keepalive(packet.payload, addr)
+            case PacketType.RESUME:
+                self._receive_resume(packet.payload, addr)
+
+        return True
+
+    def _send_keepalive(self) -> None:
+        counter = self.keepalive_counter
+        self.keepalive_counter += 1
+        tag = self.cipher.seal_batch(CONTROL_TRANSFER_ID, [(counter, b'')])[0]
+        self._send_now(Packet(PacketType.KEEPALIVE, self.session_id + counter.to_bytes(8) + tag))
+
+    def _receive_keepalive(self, payload: bytes, addr: Address) -> None:
+        session_id = payload[:SESSION_ID_SIZE]
+        counter = int.from_bytes(payload[SESSION_ID_SIZE:SESSION_ID_SIZE + 8])
+        tag = payload[SESSION_ID_SIZE + 8:]
+        # counters only go up, so a replayed keepalive can't pull the session away
+        if session_id != self.session_id or counter <= self.peer_keepalive_counter:
+            return
+        if self.cipher.open_batch(CONTROL_TRANSFER_ID, [(counter, tag)])[0] is None:
+            return
+
+        self.peer_keepalive_counter = counter
+        self._migrate(addr)
+
+    async def _keepalive(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self._send_keepalive()
+
+    def _seal_message(self, packet_type: PacketType, body: bytes = b'') -> Packet:
+        # the type is sealed along with the body, so one message can't pass for another
+        counter = self.message_counter
+        self.message_counter += 1
+        sealed = self.cipher.seal_batch(
+            MESSAGE_TRANSFER_ID,
+            [(counter, packet_type.value.to_bytes(1) + body)]
+        )[0]
+        return Packet(packet_type, counter.to_bytes(8) + sealed)
+
+    def _open_message(self, packet: Packet, addr: Address | None = None) -> bytes | None:
+        counter = int.from_bytes(packet.payload[:8])
+        body = self.cipher.open_batch(MESSAGE_TRANSFER_ID, [(counter, packet.payload[8:])])[0]
+        if (
+            body is None
+            or body[:1] != packet.type.value.to_bytes(1)
+            or counter in self.peer_message_counters
+        ):
+            return None
+
+        self.peer_message_counters.add(counter)
+        if addr is not None and addr not in self.known_addresses:
+            self._migrate(addr)
+        return body[1:]
+
+    def _resume_packet(self) -> Packet:
+        timestamp = int(time.time() * 1000).to_bytes(8)
+        data = self.session_id + self.nonce + timestamp
+        return Packet(PacketType.RESUME, data + resume_proof(self.session_secret, data))
+
+    def _receive_resume(self, payload: bytes, addr: Address) -> None:
+        data, proof = payload[:-TAG_SIZE], payload[-TAG_SIZE:]
+        session_id = data[:SESSION_ID_SIZE]
+        peer_nonce = data[SESSION_ID_SIZE:SESSION_ID_SIZE + HANDSHAKE_NONCE_SIZE]
+        timestamp = int.from_bytes(data[SESSION_ID_SIZE + HANDSHAKE_NONCE_SIZE:])
+        if (
+            session_id != self.session_id
+            or len(peer_nonce) != HANDSHAKE_NONCE_SIZE
+            or not hmac.compare_digest(proof, resume_proof(self.session_secret, data))
+        ):
+            return
+        # the peer is still waiting, our answer got lost
+        if timestamp == self.peer_resume_time and peer_nonce == self.peer_nonce:
+            if self.resume_reply is not None:
+                self._send_now(self.resume_reply)
+            return
+        if (
+            timestamp <= self.peer_resume_time
+            or abs(time.time() - timestamp / 1000) > RESUME_WINDOW
+        ):
+            return
+
+        # this is the answer to our own RESUME, both directions have fresh keys now
+        answered = self.resume_packet is not None
+        if not answered:
+            # what we send takes a new nonce as well, so datagrams recorded from the
+            # old session authenticate in neither direction
+            self.nonce = os.urandom(HANDSHAKE_NONCE_SIZE)
+            self.next_transfer_id = _first_transfer_id(self.nonce)
+
+        # the peer came back with a new nonce, so what it sends uses new keys
+        self.peer_resume_time = timestamp
+        self._start_session(self.session_secret, self.peer_public_key, peer_nonce)
+        self.peer_keepalive_counter = -1
+        self.peer_message_counters.clear()
+        # its transfer ids are from a new epoch as well
+        self.finished_transfers.clear()
+        self.resume_count += 1
+        self._migrate(addr)
+
+        if answered:
+            self.resume_packet = None
+        else:
+            self.resume_reply = self._resume_packet()
+            self._send_now(self.resume_reply)
+        self.confirmed.set()
+
+    async def _announce_resume(self, packet: Packet, interval: float, timeout: float) -> None:
+        try:
+            async with asyncio.timeout(timeout):
+                while True:
+                    try:
+                        await asyncio.wait_for(self.confirmed.wait(), interval)
+                        return
+                    except TimeoutError:
+                        self._send_now(packet)
+        except TimeoutError:
+            print("Peer didn't answer the resumed session")
+
+    async def _bind_relay(self, relay: tuple[str, int], key: bytes, interval: float) -> None:
+        family = socket.AF_UNSPEC if self.family == socket.AF_INET6 else socket.AF_INET
+        try:
+            self.address = await resolve_address(relay, family)
+        except OSError as error:
+            raise HandshakeError(f"can't resolve relay {relay[0]}: {error}") from None
+
+        async def bind() -> None:
+            while True:
+                await self.send(Packet(PacketType.RELAY_BIND, key))
+                await asyncio.sleep(interval)
+
+        binding = asyncio.create_task(bind())
+        try:
+            while True:
+                data, addr = await self.protocol.recvfrom()
+                if normalize_address(addr) != self.address:
+                    continue
+
+                packet = unpack_packet(data)
+                if packet is None:
+                    continue
+
+                match packet.type:
+                    case PacketType.RELAY_REDIRECT:
+                        self.address = (self.address[0], int.from_bytes(packet.payload[:2]))
+                    case PacketType.RELAY_READY:
+                        break
+        finally:
+            binding.cancel()
+
+    async def _race(self, candidates: list[Address], probe_interval: float) -> None:
+        # all candidates are probed at once, so the first one to answer is the
+        # lowest-RTT working path (ICE connectivity checks, happy eyeballs style)
+        if self.family != socket.AF_INET6:
+            candidates = [candidate for candidate in candidates if ':' not in candidate[0]]
+
+        probing = asyncio.create_task(self._probe(candidates, probe_interval))
+        try:
+            while True:
+                data, addr = await self.protocol.recvfrom()
+                # anyone can reach the port, and a previous session may still be
+                # sending to it, so anything but an authentic hello is ignored
+                packet = unpack_packet(data)
+                if (
+                    packet is not None
+                    and packet.type in (PacketType.CONNECT, PacketType.ACCEPT)
+                    and self._authenticate(packet.payload)
+                ):
+                    break
+        finally:
+            probing.cancel()
+
+        # only the path the peer answered on, the other candidates are unverified
+        self.address = normalize_address(addr)
+        self.known_addresses.add(self.address)
+
+        if packet.type == PacketType.CONNECT:
+            await self.send(Packet(PacketType.ACCEPT, self._hello()))
+        self.state = PeerState.CONNECTED
+
+    async def send(self, packet: Packet) -> None:
+        with tracer.span('pack'):
+            data = packet.pack()
+        with tracer.span('sendto'):
+            self.transport.sendto(data, to_socket_address(self.address, self.family))
+
+    async def receive(self) -> Packet:
+        while True:
+            packet, addr = await self._receive_from()
+            if addr in self.known_addresses:
+                return packet
+
+    async def _receive_from(self) -> tuple[Packet, Address]:
+        while True:
+            data, addr = await self.protocol.recvfrom()
+            addr = normalize_address(addr)
+            packet = unpack_packet(data)
+            if packet is None:
+                continue
+
+            # before the peer answers our RESUME, anything sealed may be a recording
+            # of the old session
+            if self.resume_packet is not None and packet.type in SEALED_PACKET_TYPES:
+                continue
+            # a NAT that rebinds the peer's port changes its address mid-transfer; sealed
+            # packets are let through and the address is trusted once one authenticates
+            if addr not in self.known_addresses:
+                if packet.type in SEALED_PACKET_TYPES:
+                    return packet, addr
+                continue
+
+            match packet.type:
+                # happens when NAT is already open so ACCEPT packets end up on both sides,
+                # or when probes over slower paths arrive after the race is decided
+                case PacketType.ACCEPT:
+                    continue
+                case PacketType.CONNECT:
+                    await self.send(Packet(PacketType.ACCEPT, self._hello()))
+                    continue
+                # leftovers from binding to a relay
+                case packet_type if packet_type in RELAY_PACKET_TYPES:
+                    continue
+
+            return packet, addr
+    
+    async def _send_chunk(self, chunk_index: int, chunk_data: bytes) -> None:
+        await self.send(Packet(
+            PacketType.TRANSFER_CHUNK,
+            chunk_index.to_bytes(4) + chunk_data
+        ))
+    
+    async def _send_chunks(self, transfer_id: int, chunks: list[tuple[int, bytes]]) -> None:
+        self._repeat_resume()
+        sealed_chunks = await self.cipher.seal(transfer_id, chunks)
+        for (offset, _), sealed_data in zip(chunks, sealed_chunks):
+            await self._send_chunk(offset // MAX_CHUNK_SIZE, sealed_data)
+
+    def _repeat_resume(self) -> None:
+        # 0-RTT data is sealed with the new keys, the peer can't open it until our RESUME
+        # gets through, so it goes out again in front of everything until it's answered
+        if self.resume_packet is not None:
+            self._send_now(self.resume_packet)
+
+    async def _request_status(
+        self,
+        packet_type: PacketType,
+        transfer_id: int,
+        body: bytes = b''
+    ) -> tuple[bool, list[int]]:
+        try:
+            async with asyncio.timeout(STATUS_TIMEOUT):
+                while True:
+                    # sealed afresh every time, a resent message would be dropped as a replay
+                    self._repeat_resume()
+                    await self.send(self._seal_message(packet_type, transfer_id.to_bytes(4) + body))
+                    with suppress(TimeoutError):
+                        async with asyncio.timeout(STATUS_INTERVAL):
+                            return await self._receive_status(packet_type, transfer_id)
+        except TimeoutError:
+            raise TransferError(f"receiver stopped answering (transfer {transfer_id})") from None
+
+    async def _receive_status(self, packet_type: PacketType, transfer_id: int) -> tuple[bool, list[int]]:
+        while True:
+            packet, addr = await self._receive_from()
+            if packet.type != PacketType.TRANSFER_STATUS:
+                continue
+            status = self._open_message(packet, addr)
+            if status is None or int.from_bytes(status[:4]) != transfer_id:
+                continue
+
+            done = status[4:5] == b'\x01'
+            missing: list[int] = []
+            for position in range(5, len(status) - 5, 6):
+                first = int.from_bytes(status[position:position + 4])
+                missing.extend(range(first, first + int.from_bytes(status[position + 4:position + 6])))
+            # a late answer to TRANSFER_BEGIN says nothing about what's missing
+            if packet_type == PacketType.TRANSFER_END and not done and not missing:
+                continue
+
+            return done, missing
+
+    def _send_status(
+        self,
+        transfer_id: int,
+        done: bool,
+        missing: list[tuple[int, int]] | None = None
+    ) -> None:
+        body = transfer_id.to_bytes(4) + (b'\x01' if done else b'\x00')
+        body += b''.join(first.to_bytes(4) + count.to_bytes(2) for first, count in missing or ())
+        self._send_now(self._seal_message(PacketType.TRANSFER_STATUS, body))
+
+    async def send_file(self, path: str, policy: IOPolicy = DEFAULT_POLICY) -> None:
+        file_size = os.stat(path).st_size
+        filename = str(path).replace('\\', '/').split('/')[-1] or 'unknown'
+
+        # part of every chunk nonce, so offsets never repeat under the same key
+        transfer_id = self.next_transfer_id
+        self.next_transfer_id += 1
+
+        # nothing is sent until the receiver has the file open, a lost TRANSFER_BEGIN
+        # would throw away every chunk behind it
+        done, _ = await self._request_status(
+            PacketType.TRANSFER_BEGIN,
+            transfer_id,
+            file_size.to_bytes(8) + filename[:256].encode()
+        )
+        print("Transfer started!")
+
+        chunk_index = 0
+        batch: list[tuple[int, bytes]] = []
+        async for chunk_data in read_chunks(path, MAX_CHUNK_SIZE, policy):
+            batch.append((chunk_index * MAX_CHUNK_SIZE, chunk_data))
+            chunk_index += 1
+
+            if len(batch) == CRYPTO_BATCH_SIZE:
+                await self._send_chunks(transfer_id, batch)
+                batch = []
+
+        if batch:
+            await self._send_chunks(transfer_id, batch)
+
+        # the file only counts as sent once the receiver has every chunk, whatever
+        # was lost on the way is sent again
+        loop = asyncio.get_running_loop()
+        while not done:
+            done, missing = await self._request_status(PacketType.TRANSFER_END, transfer_id)
+            if missing:
+                chunks = await loop.run_in_executor(None, read_chunks_at, path, MAX_CHUNK_SIZE, missing)
+                await self._send_chunks(transfer_id, chunks)
+
+    async def _receive_batch(
+        self,
+        max_count: int
+    ) -> tuple[list[tuple[int, bytes]], list[Address], list[tuple[Packet, Address]]]:
+        # waits for one packet, then takes whatever else is already queued
+        chunks: list[tuple[int, bytes]] = []
+        chunk_sources: list[Address] = []
+        messages: list[tuple[Packet, Address]] = []
+        while len(chunks) < max_count:
+            packet, addr = await self._receive_from()
+            if packet.type == PacketType.TRANSFER_CHUNK:
+                chunk_index = int.from_bytes(packet.payload[:4])
+                chunks.append((chunk_index * MAX_CHUNK_SIZE, packet.payload[4:]))
+                chunk_sources.append(addr)
+            else:
+                messages.append((packet, addr))
+
+            if self.protocol.packets.empty():
+                break
+
+        return chunks, chunk_sources, messages
+
+    async def _receive_begin(self) -> bytes | None:
+        # the next file's header, or None once the sender is done with this session
+        while True:
+            initial_packet, addr = await self._receive_from()
+            if initial_packet.type not in TRANSFER_MESSAGE_TYPES:
+                continue
+            # anything unsealed is forged, or replayed if its counter was seen before
+            header = self._open_message(initial_packet, addr)
+            if header is None:
+                continue
+
+            if initial_packet.type == PacketType.DISCONNECT:
+                return None
+
+            transfer_id = int.from_bytes(header[:4])
+            # our last answer got lost, the sender is still asking about a finished file
+            if transfer_id in self.finished_transfers:
+                self._send_status(transfer_id, True)
+                continue
+            if initial_packet.type == PacketType.TRANSFER_BEGIN:
+                return header
+
+    async def receive_file(
+        self,
+        directory: str = '.',
+        policy: IOPolicy = DEFAULT_POLICY
+    ) -> AsyncFileIO | None:
+        header = await self._receive_begin()
+        while header is not None:
+            transfer_id = int.from_bytes(header[:4])
+            file_size = int.from_bytes(header[4:12])
+            chunk_count = math.ceil(file_size / MAX_CHUNK_SIZE)
+            # the name comes from the network, never let it leave the target directory
+            file_name = os.path.basename(header[12:268].decode()) or 'unknown'
+            path = os.path.join(directory, file_name)
+
+            print(f"Receiving file `{file_name}` ({chunk_count} chunks, {round(file_size / 1024 / 1024)} MiB)")
+
+            # unbuffered, every chunk is its own positioned write anyway
+            async with aiofiles.open(path, 'w+b', buffering=0) as f:
+                await f.truncate(file_size)
+                writeback = Writeback(f.fileno(), policy)
+                self._send_status(transfer_id, False)
+                resume_count = self.resume_count
+
+                # a replayed chunk authenticates just as well, so each index counts once
+                received = bytearray(-(-chunk_count // 8))
+                received_count = 0
+                # set when the sender gives up on this file and begins the next one
+                next_header: bytes | None = None
+                while received_count < chunk_count and next_header is None:
+                    chunks, chunk_sources, messages = await self._receive_batch(CRYPTO_BATCH_SIZE)
+                    # the peer came back with new keys, nothing of this file can arrive anymore
+                    if self.resume_count != resume_count:
+                        raise TransferError("peer resumed the session in the middle of a transfer")
+                    if chunks:
+                        opened_chunks = await self.cipher.open(transfer_id, chunks)
+                        # only authentic chunks count, a forged index could point anywhere
+                        new_chunks: list[tuple[int, bytes]] = []
+
+                        for (offset, _), chunk_data, source in zip(chunks, opened_chunks, chunk_sources):
+                            # failed authentication, not from the peer
+                            if chunk_data is None:
+                                continue
+
+                            chunk_index = offset // MAX_CHUNK_SIZE
+                            bit = 1 << chunk_index % 8
+                            if chunk_index >= chunk_count or received[chunk_index // 8] & bit:
+                                continue
+                            received[chunk_index // 8] |= bit
+                            new_chunks.append((offset, chunk_data))
+                            # only a chunk seen for the first time, a replayed one mustn't move us
+                            if source not in self.known_addresses:
+                                self._migrate(source)
+                            received_count += 1
+
+                        if new_chunks:
+                            await write_chunks(f.fileno(), new_chunks)
+                            # keeps dirty pages bounded instead of flushing the whole file at the end
+                            await writeback.advance(max(offset for offset, _ in new_chunks) + MAX_CHUNK_SIZE)
+
+                    # after the chunks, so TRANSFER_END sees every chunk that was queued before it
+                    for message, addr in messages:
+                        next_header = self._handle_transfer_message(
+                            message, addr, header, received, chunk_count
+                        ) or next_header
+
+                if next_header is None:
+                    await writeback.finish()
+
+            if next_header is None:
+                self.finished_transfers.add(transfer_id)
+                self._send_status(transfer_id, True)
+                return f
+
+            # a partial file is no use to anyone, the session goes on with the next one
+            print(f"Sender gave up on `{file_name}`")
+            os.remove(path)
+            header = next_header
+
+        # the sender is done with this session
+        self.state = PeerState.DISCONNECTED
+        return None
+
+    def _handle_transfer_message(
+        self,
+        packet: Packet,
+        addr: Address,
+        header: bytes,
+        received: bytearray,
+        chunk_count: int
+    ) -> bytes | None:
+        # returns the header of a later file the sender moved on to
+        transfer_id = int.from_bytes(header[:4])
+        if packet.type not in TRANSFER_MESSAGE_TYPES:
+            return None
+        body = self._open_message(packet, addr)
+        if body is None:
+            return None
+
+        if packet.type == PacketType.DISCONNECT:
+            self.state = PeerState.DISCONNECTED
+            raise TransferError("peer disconnected in the middle of a transfer")
+
+        message_transfer_id = int.from_bytes(body[:4])
+        if message_transfer_id in self.finished_transfers:
+            self._send_status(message_transfer_id, True)
+            return None
+        if message_transfer_id != transfer_id:
+            # transfer ids only go up, anything older is a leftover of an abandoned file
+            if packet.type == PacketType.TRANSFER_BEGIN and message_transfer_id > transfer_id:
+                return body
+            return None
+
+        if packet.type == PacketType.TRANSFER_BEGIN:
+            # a different file under the same id isn't a repeat, the sender moved on
+            if body != header:
+                return body
+            # our first answer got lost
+            self._send_status(transfer_id, False)
+            return None
+
+        self._send_status(transfer_id, False, _missing_ranges(received, chunk_count))
+        return None
+
+    async def receive_files(
+        self,
+        directory: str = '.',
+        policy: IOPolicy = DEFAULT_POLICY
+    ) -> AsyncGenerator[AsyncFileIO]:
+        while (file := await self.receive_file(directory, policy)) is not None:
+            yield file
+
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+
+        if self.state != PeerState.DISCONNECTED:
+            # nothing acknowledges it, so say it a few times
+            disconnect_packet = self._seal_message(PacketType.DISCONNECT)
+            for _ in range(DISCONNECT_REPEATS):
+                await self.send(disconnect_packet)
+            self.state = PeerState.DISCONNECTED
+
+        self.transport.close()
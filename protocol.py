@@ -1,15 +1,22 @@
 import asyncio
 from asyncio import DatagramProtocol
+from collections.abc import Callable
 
+from tracing import tracer
 from utils import Address
 
 
 class PeerProtocol(DatagramProtocol):
     def __init__(self) -> None:
         self.packets: asyncio.Queue[tuple[bytes, Address]] = asyncio.Queue()
+        # consumes control packets as they arrive, even while nobody is receiving
+        self.control_handler: Callable[[bytes, Address], bool] | None = None
 
     def datagram_received(self, data: bytes, addr: Address) -> None:
+        if self.control_handler is not None and self.control_handler(data, addr):
+            return
         self.packets.put_nowait((data, addr))
 
     async def recvfrom(self):
-        return await self.packets.get()
+        with tracer.span('queue_wait'):
+            return await self.packets.get()
@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import time
+import zlib
+from dataclasses import dataclass, field
+
+from packet import Packet, PacketType
+
+RELAY_PORT = 2026
+# enough for any UDP datagram, reused for every receive so forwarding never allocates
+BUFFER_SIZE = 65536
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+@dataclass
+class RelaySession:
+    key: bytes
+    rate_limit: int | None = None  # bytes per second, per session
+    members: list[tuple] = field(default_factory=list)
+    tokens: float = 0.0
+    refilled_at: float = field(default_factory=time.monotonic)
+    last_seen: float = field(default_factory=time.monotonic)
+    bytes_forwarded: int = 0
+    packets_forwarded: int = 0
+    packets_dropped: int = 0
+
+    def __post_init__(self) -> None:
+        self.tokens = self.rate_limit or 0
+
+    def consume(self, size: int, now: float) -> bool:
+        if self.rate_limit is None:
+            return True
+
+        # token bucket with one second of burst
+        self.tokens = min(
+            self.tokens + (now - self.refilled_at) * self.rate_limit,
+            self.rate_limit
+        )
+        self.refilled_at = now
+        if self.tokens < size:
+            return False
+
+        self.tokens -= size
+        return True
+
+
+class RelayWorker:
+    def __init__(
+        self,
+        sock: socket.socket,
+        *,
+        base_port: int,
+        worker_count: int,
+        rate_limit: int | None = None,
+        batch_size: int = 256,
+        session_timeout: float = 60.0
+    ) -> None:
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.base_port = base_port
+        self.worker_count = worker_count
+        self.rate_limit = rate_limit
+        self.batch_size = batch_size
+        self.session_timeout = session_timeout
+
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.sessions: dict[bytes, RelaySession] = {}
+        # source address -> (session, destination address) for bound pairs
+        self.routes: dict[tuple, tuple[RelaySession, tuple]] = {}
+
+    def owner_port(self, key: bytes) -> int:
+        # crc32 rather than hash() so every worker process agrees on the owner
+        return self.base_port + zlib.crc32(key) % self.worker_count
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.sock, self._drain)
+        try:
+            while True:
+                await asyncio.sleep(self.session_timeout / 2)
+                self._expire_sessions()
+        finally:
+            loop.remove_reader(self.sock)
+
+    def _drain(self) -> None:
+        # one wakeup forwards up to a whole batch, straight from the shared buffer
+        now = time.monotonic()
+        for _ in range(self.batch_size):
+            try:
+                size, addr = self.sock.recvfrom_into(self.buffer)
+            except BlockingIOError:
+                return
+            except OSError:
+                continue
+
+            route = self.routes.get(addr)
+            # a bound member still binding never got its RELAY_READY, answer rather than forward
+            if route is None or self.buffer[0] == PacketType.RELAY_BIND.value:
+                self._handle_control(bytes(self.view[:size]), addr, now)
+                continue
+
+            session, destination = route
+            session.last_seen = now
+            if not session.consume(size, now):
+                session.packets_dropped += 1
+                continue
+
+            try:
+                self.sock.sendto(self.view[:size], destination)
+            except OSError:
+                # full socket buffer, drop like any other router would
+                session.packets_dropped += 1
+                continue
+
+            session.bytes_forwarded += size
+            session.packets_forwarded += 1
+
+    def _handle_control(self, data: bytes, addr: tuple, now: float) -> None:
+        try:
+            packet = Packet.unpack(data)
+        except ValueError:
+            return
+        if packet.type != PacketType.RELAY_BIND or not packet.payload:
+            return
+
+        key = packet.payload
+        owner_port = self.owner_port(key)
+        if owner_port != self.port:
+            self._send_control(Packet(PacketType.RELAY_REDIRECT, owner_port.to_bytes(2)), addr)
+            return
+
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = RelaySession(key, self.rate_limit)
+        session.last_seen = now
+
+        if addr in session.members:
+            # its RELAY_READY got lost, or the other member hasn't bound yet
+            if len(session.members) == 2:
+                self._send_control(Packet(PacketType.RELAY_READY), addr)
+            return
+        if len(session.members) == 2:
+            return
+
+        session.members.append(addr)
+        print(f"[{self.port}] {addr[0]}:{addr[1]} bound to session {key.hex()[:8]}")
+
+        if len(session.members) == 2:
+            first, second = session.members
+            self.routes[first] = (session, second)
+            self.routes[second] = (session, first)
+            for member in session.members:
+                self._send_control(Packet(PacketType.RELAY_READY), member)
+
+    def _send_control(self, packet: Packet, addr: tuple) -> None:
+        try:
+            self.sock.sendto(packet.pack(), addr)
+        except OSError:
+            pass
+
+    def _expire_sessions(self) -> None:
+        now = time.monotonic()
+        for key, session in list(self.sessions.items()):
+            if now - session.last_seen < self.session_timeout:
+                print(
+                    f"[{self.port}] session {key.hex()[:8]}: {session.bytes_forwarded} bytes, "
+                    f"{session.packets_forwarded} packets forwarded, {session.packets_dropped} dropped"
+                )
+                continue
+
+            del self.sessions[key]
+            for member in session.members:
+                self.routes.pop(member, None)
+            print(f"[{self.port}] session {key.hex()[:8]} expired")
+
+
+def create_relay_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+
+def run_worker(
+    sock: socket.socket,
+    base_port: int,
+    worker_count: int,
+    rate_limit: int | None
+) -> None:
+    worker = RelayWorker(
+        sock,
+        base_port=base_port,
+        worker_count=worker_count,
+        rate_limit=rate_limit
+    )
+    try:
+        asyncio.run(worker.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(
+    host: str = '0.0.0.0',
+    port: int = RELAY_PORT,
+    *,
+    workers: int = 1,
+    rate_limit: int | None = None
+) -> None:
+    # bound up front, so a port that's taken fails here instead of in a worker
+    sockets: list[socket.socket] = []
+    try:
+        for index in range(workers):
+            sockets.append(create_relay_socket(host, port + index))
+    except OSError:
+        for sock in sockets:
+            sock.close()
+        raise
+
+    # one process per core, each owning its own port; sessions are pinned to a
+    # worker by key and clients are redirected there from the base port
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(sock, port, workers, rate_limit),
+            daemon=True
+        )
+        for sock in sockets
+    ]
+    for process in processes:
+        process.start()
+    # the workers have their own copies
+    for sock in sockets:
+        sock.close()
+
+    print(f"Relay listening on {host}:{port}-{port + workers - 1}")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="birdge relay server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=RELAY_PORT)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--rate-limit', type=int, help="bytes per second per session")
+    args = parser.parse_args()
+
+    try:
+        serve(args.host, args.port, workers=args.workers, rate_limit=args.rate_limit)
+    except OSError as error:
+        parser.exit(1, f"relay: can't bind {args.host}:{args.port}: {error}\n")
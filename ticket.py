@@ -0,0 +1,46 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Self
+
+from utils import Address
+
+
+@dataclass
+class ResumptionTicket:
+    session_id: bytes
+    session_secret: bytes
+    public_key: bytes
+    peer_public_key: bytes
+    # the peer's send keys are salted with this, see ChunkCipher.from_secret
+    peer_nonce: bytes
+    address: Address
+
+    def save(self, path: str) -> None:
+        data = {
+            'session_id': self.session_id.hex(),
+            'session_secret': self.session_secret.hex(),
+            'public_key': self.public_key.hex(),
+            'peer_public_key': self.peer_public_key.hex(),
+            'peer_nonce': self.peer_nonce.hex(),
+            'address': list(self.address),
+        }
+
+        # holds the session secret, so only the owner may read it
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, path: str) -> Self:
+        with open(path) as f:
+            data = json.load(f)
+
+        return cls(
+            bytes.fromhex(data['session_id']),
+            bytes.fromhex(data['session_secret']),
+            bytes.fromhex(data['public_key']),
+            bytes.fromhex(data['peer_public_key']),
+            bytes.fromhex(data['peer_nonce']),
+            (data['address'][0], data['address'][1])
+        )
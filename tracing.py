@@ -0,0 +1,137 @@
+import asyncio
+import cProfile
+import json
+import os
+import threading
+import time
+from collections.abc import Awaitable
+from typing import TypeVar
+
+T = TypeVar('T')
+
+# keeps a long transfer from growing the trace without bound, totals keep counting
+MAX_EVENTS = 1_000_000
+
+
+class _NoSpan:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+NO_SPAN = _NoSpan()
+
+
+def _current_lane() -> tuple[int, str]:
+    # tasks interleave on the loop thread, so spans only nest within one task
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return id(task), task.get_name()
+
+    thread = threading.current_thread()
+    return thread.ident, thread.name
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'started')
+
+    def __init__(self, tracer: 'Tracer', name: str) -> None:
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info) -> None:
+        self.tracer.record(self.name, self.started, time.perf_counter_ns())
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.sample_every = 1
+        self.events: list[dict] = []
+        self.counters: dict[str, int] = {}
+        # stage -> (sampled spans, sampled nanoseconds)
+        self.totals: dict[str, tuple[int, int]] = {}
+        # trace tid -> task or thread name
+        self.lanes: dict[int, str] = {}
+
+    def enable(self, sample_every: int = 1) -> None:
+        if sample_every < 1:
+            raise ValueError(f"sample_every must be at least 1, got {sample_every}")
+
+        self.enabled = True
+        self.sample_every = sample_every
+
+    def span(self, name: str) -> _Span | _NoSpan:
+        if not self.enabled:
+            return NO_SPAN
+
+        # sampled per stage, so rare stages show up as well as the hot ones
+        count = self.counters.get(name, 0)
+        self.counters[name] = count + 1
+        if count % self.sample_every:
+            return NO_SPAN
+
+        return _Span(self, name)
+
+    def record(self, name: str, started: int, finished: int) -> None:
+        spans, duration = self.totals.get(name, (0, 0))
+        self.totals[name] = (spans + 1, duration + finished - started)
+
+        if len(self.events) < MAX_EVENTS:
+            lane, lane_name = _current_lane()
+            self.lanes.setdefault(lane, lane_name)
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': started / 1000,
+                'dur': (finished - started) / 1000,
+                'pid': os.getpid(),
+                'tid': lane,
+            })
+
+    def write(self, path: str) -> None:
+        # Chrome trace event format, opens in chrome://tracing and Perfetto
+        # one track per task or thread, labelled with its name
+        lane_names = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': lane, 'args': {'name': name}}
+            for lane, name in self.lanes.items()
+        ]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': lane_names + self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self) -> str:
+        lines = [f"{'stage':<12} {'spans':>10} {'mean':>10} {'total (est.)':>14}"]
+        for name, (spans, duration) in sorted(
+            self.totals.items(),
+            key=lambda item: item[1][1],
+            reverse=True
+        ):
+            total = self.counters[name] * duration / spans
+            lines.append(
+                f"{name:<12} {self.counters[name]:>10} {duration / spans / 1000:>8.1f}us "
+                f"{total / 1e9:>13.3f}s"
+            )
+
+        return '\n'.join(lines)
+
+
+tracer = Tracer()
+
+
+async def profile(awaitable: Awaitable[T], path: str) -> T:
+    # only the event loop thread is profiled, executor work shows up as waits
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return await awaitable
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -1,18 +1,20 @@
 import asyncio
 import base64
+import hashlib
+import ipaddress
 import socket
-from collections.abc import AsyncGenerator
 
-from aiofiles.threadpool.binary import AsyncBufferedReader
+from crypto import FINGERPRINT_SIZE
 
 Address = tuple[str, int]
 
-file_lock = asyncio.Lock()
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
 
 
 def parse_address(addr: str) -> tuple[str, int]:
-	ip, port = addr.split(':', 1)
-	return ip, int(port)
+	# the port follows the last colon, so IPv6 literals work with or without brackets
+	host, _, port = addr.rpartition(':')
+	return host.removeprefix('[').removesuffix(']'), int(port)
 
 
 def address_to_code(addr: tuple[str, int]) -> str:
@@ -26,6 +28,115 @@ def code_to_address(code: str) -> tuple[str, int]:
 	return socket.inet_ntoa(ip), int.from_bytes(port)
 
 
+def candidates_to_code(candidates: list[Address], fingerprint: bytes = b'') -> str:
+	code_bytes = b''
+	if fingerprint:
+		code_bytes += b'\x00' + fingerprint
+
+	for ip, port in candidates:
+		if ':' in ip:
+			code_bytes += b'\x06' + socket.inet_pton(socket.AF_INET6, ip)
+		else:
+			code_bytes += b'\x04' + socket.inet_aton(ip)
+		code_bytes += port.to_bytes(2, 'big')
+
+	return base64.urlsafe_b64encode(code_bytes).decode()
+
+
+def _parse_code(code: str) -> tuple[list[Address], bytes]:
+	code_bytes = base64.urlsafe_b64decode(code)
+	# codes without a family tag hold a single IPv4 address (old format)
+	if len(code_bytes) == 6:
+		return [code_to_address(code)], b''
+
+	candidates: list[Address] = []
+	fingerprint = b''
+	position = 0
+	while position < len(code_bytes):
+		match code_bytes[position]:
+			case 0:
+				fingerprint = code_bytes[position + 1:position + 1 + FINGERPRINT_SIZE]
+				position += 1 + FINGERPRINT_SIZE
+				continue
+			case 4:
+				ip_size, family = 4, socket.AF_INET
+			case 6:
+				ip_size, family = 16, socket.AF_INET6
+			case tag:
+				raise ValueError(f"unknown address family tag in code ({tag})")
+
+		ip_bytes = code_bytes[position + 1:position + 1 + ip_size]
+		port_bytes = code_bytes[position + 1 + ip_size:position + 3 + ip_size]
+		if len(port_bytes) != 2:
+			raise ValueError("truncated code")
+
+		candidates.append((socket.inet_ntop(family, ip_bytes), int.from_bytes(port_bytes, 'big')))
+		position += 3 + ip_size
+
+	return candidates, fingerprint
+
+
+def code_to_candidates(code: str) -> list[Address]:
+	return _parse_code(code)[0]
+
+
+def code_to_fingerprint(code: str) -> bytes:
+	fingerprint = _parse_code(code)[1]
+	if len(fingerprint) != FINGERPRINT_SIZE:
+		raise ValueError("code carries no key fingerprint")
+	return fingerprint
+
+
+def session_key(code: str, peer_code: str) -> bytes:
+	# both sides derive the same key no matter who is who
+	return hashlib.sha256('/'.join(sorted((code, peer_code))).encode()).digest()[:16]
+
+
+def normalize_address(addr: tuple) -> Address:
+	# dual-stack sockets report IPv4 peers as 4-tuples with a mapped address
+	ip = addr[0]
+	if ip.startswith('::ffff:') and '.' in ip:
+		ip = ip.removeprefix('::ffff:')
+	return ip, addr[1]
+
+
+def to_socket_address(addr: Address, family: socket.AddressFamily) -> Address:
+	ip, port = addr
+	if family == socket.AF_INET6 and ':' not in ip:
+		return f'::ffff:{ip}', port
+	return ip, port
+
+
+async def resolve_address(addr: tuple[str, int], family: socket.AddressFamily) -> Address:
+	# hosts may be names, sockets only take IPs
+	loop = asyncio.get_running_loop()
+	results = await loop.getaddrinfo(addr[0], addr[1], family=family, type=socket.SOCK_DGRAM)
+	# IPv4 first: "localhost" often resolves to ::1 first, and a relay on 0.0.0.0 isn't there
+	results.sort(key=lambda result: result[0] != socket.AF_INET)
+	return normalize_address(results[0][4])
+
+
+def create_udp_socket(port: int) -> socket.socket:
+	# prefer a dual-stack socket so one port serves both IPv4 and IPv6 candidates
+	try:
+		sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+		try:
+			sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+			sock.bind(('::', port))
+		except OSError:
+			sock.close()
+			raise
+	except OSError:
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.bind(('0.0.0.0', port))
+
+	# chunks are sent in batches, the default buffer can't hold one (capped by rmem_max)
+	for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+		sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+
+	return sock
+
+
 def get_external_address(
 	*,
 	timeout: float = 30.0,
@@ -51,27 +162,58 @@ def get_external_address(
 	return socket.inet_ntoa(data[28:32]), int.from_bytes(data[26:28], 'big')
 
 
+def get_local_addresses(port: int) -> list[Address]:
+	ips: list[str] = []
+
+	# connecting a UDP socket sends nothing, it only picks the outgoing interface
+	for family, probe_host in (
+		(socket.AF_INET, '192.0.2.1'),
+		(socket.AF_INET6, '2001:db8::1'),
+	):
+		try:
+			with socket.socket(family, socket.SOCK_DGRAM) as sock:
+				sock.connect((probe_host, 9))
+				ips.append(sock.getsockname()[0])
+		except OSError:
+			continue
+
+	try:
+		host_info = socket.getaddrinfo(socket.gethostname(), None, type=socket.SOCK_DGRAM)
+	except OSError:
+		host_info = []
+	ips.extend(str(sockaddr[0]) for *_, sockaddr in host_info)
+
+	addresses: list[Address] = []
+	for ip in ips:
+		parsed = ipaddress.ip_address(ip)
+		# loopback would make a remote peer talk to itself, link-local needs a scope id
+		if parsed.is_loopback or parsed.is_link_local or parsed.is_unspecified:
+			continue
+		if (str(parsed), port) not in addresses:
+			addresses.append((str(parsed), port))
+
+	return addresses
+
+
+def gather_candidates(
+	port: int = 2025,
+	*,
+	stun_timeout: float = 5.0
+) -> list[Address]:
+	candidates = get_local_addresses(port)
+	try:
+		external_addr = get_external_address(timeout=stun_timeout, source_port=port)
+	except OSError:
+		# no STUN answer, local candidates are still enough on a LAN
+		return candidates
+
+	if external_addr not in candidates:
+		candidates.append(external_addr)
+	return candidates
+
+
 # def chunkify(data: bytes, chunk_size: int) -> Iterable[bytes]:
 # 	return (
 # 		data[chunk_position:chunk_position + chunk_size]
 # 		for chunk_position in range(0, len(data), chunk_size)
 # 	)
-
-
-async def chunkify_file(
-	file: AsyncBufferedReader,
-	chunk_size: int
-) -> AsyncGenerator[bytes]:
-	while chunk := await file.read(chunk_size):
-		yield chunk
-
-
-async def save_chunk(
-	file: AsyncBufferedReader,
-	chunk_index: int,
-	chunk_size: int,
-	chunk_data: bytes
-) -> None:
-	# async with file_lock:
-	await file.seek(chunk_index * chunk_size)
-	await file.write(chunk_data)